@@ -16,7 +16,11 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import bisect
+import itertools
+import struct
 import sys
+import time
 from optparse import OptionParser
 import os
 
@@ -26,6 +30,22 @@ MOD_BINARY  = 5
 
 MIN_BREAK = 100
 
+# Longest packet in samples. Longer packets (e.g. noise while the
+# squelch is open) are dropped, so that memory use stays bounded.
+MAX_PACKET_LENGTH = 100000
+
+# Shortest part of a packet worth decoding when a packet needs to be
+# split (one EnergyCount 3000 frame is 336 bits long)
+MIN_SEGMENT_BITS = 336
+
+# Run-length encoded sample stream consists of 32-bit little-endian
+# records. The highest bit is the sample value and the remaining bits are
+# the number of consecutive samples with that value. Consecutive records
+# may have the same value.
+RUN_FORMAT = '<I'
+RUN_SIZE = struct.calcsize(RUN_FORMAT)
+RUN_MAX_LENGTH = 0x7fffffff
+
 verbose = False
 
 def log(msg):
@@ -33,6 +53,10 @@ def log(msg):
 		sys.stderr.write(msg + "\n")
 
 class Packet:
+	"""Baseband samples of a single packet
+
+	start -- index of the first packet sample in the input stream
+	"""
 	TRIM = 10
 	expected_bit_size = 4
 	
@@ -113,96 +137,150 @@ class Packet:
 				break
 		return data[start:-stop]
 	
-	def recover_clock(self):
-		cp = None
-		
-		#print ''.join([str(i) for i in self.data]).replace('0', '.')
-		print ''.join([str(i) for i in self.trim(self.data)]).replace('0', '.')
-		
-		if len(self.data) < 50:
-			return False
-		
+	def pulses(self, data):
+		"""Returns a list of (value, length, offset) tuples, one for each
+		pulse in data, except the last one"""
+		pulses = []
+
 		pt = 0
-		# find shortest pulse length in packet
-		for tt, v in enumerate(self.trim(self.data)):
+		for tt, v in enumerate(data):
 			if tt == 0:
 				pv = v
 			t = tt+1
 			if pv != v:
-				pl = t - pt
-				#print pl, 'from', pt, 'to', t, pv, '->', v
-				if pl < 2:
-					log('pulse too short %d' % (pl,))
-					return False
-				if cp is None:
-					cp = pl
-				if pl < cp:
-					cp = pl
+				pulses.append((pv, t - pt, pt))
 				pv = v
 				pt = t
-		
-		if cp is None:
-			return False
-		
-		cp = float(cp)
-		#print 'cp estimate = %s' % cp
-		v = self.data[0]
+
+		return pulses
+
+	def split_pulses(self, pulses):
+		"""Split pulses into segments at pulses that are too short"""
+		segments = [[]]
+		for pulse in pulses:
+			pl = pulse[1]
+			if pl < 2:
+				log('pulse too short %d' % (pl,))
+				segments.append([])
+			else:
+				segments[-1].append(pulse)
+
+		return [ segment for segment in segments if segment ]
+
+	def adjust_clock(self, pulses):
+		"""Recover clock period from pulses
+
+		Returns a (cp, n) tuple, where cp is the clock period and n is
+		the number of pulses from the start that are consistent with it.
+		"""
+		# find shortest pulse length
+		cp = float(min(pl for pv, pl, pt in pulses))
+
 		# adjust clock
-		pt = 0
-		for tt, v in enumerate(self.trim(self.data)):
-			if tt == 0:
-				pv = v
-			t = tt+1
-			if pv != v:
-				pl = t - pt
-				if (pl < cp):
-					cp = (cp*2.0 + pl) / 3.0
-				elif pl > cp:
-					r = pl / cp
-					#print pl, cp
-					n = round(r)
-					e = abs((r-n)/n)
-					if e > 0.4:
-						#print e
-						log('inconsistent pulse length')
-						return False
-					if n > 20:
-						log('too many consecutive same bits')
-						return False
-					cp = (cp*2.0 + pl/n) / 3.0
-				pv = v
-				pt = t
-		
-		#print 'cp got = %s' % cp
-		# decode bits
-		pt = 0
-		for tt, v in enumerate(self.trim(self.data)):
-			if tt == 0:
-				pv = v
-			t = tt+1
-			if pv != v:
-				pl = t - pt
-				
+		for n, (pv, pl, pt) in enumerate(pulses):
+			if (pl < cp):
+				cp = (cp*2.0 + pl) / 3.0
+			elif pl > cp:
 				r = pl / cp
-				nbits = int(round(r))
-				
-				for n in xrange(nbits):
-					self.push_bit(pv)
-				pv = v
-				pt = t
+				nb = round(r)
+				e = abs((r-nb)/nb)
+				if e > 0.4:
+					log('inconsistent pulse length')
+					return cp, n
+				if nb > 20:
+					log('too many consecutive same bits')
+					return cp, n
+				cp = (cp*2.0 + pl/nb) / 3.0
+
+		return cp, len(pulses)
+
+	def recover_clock(self):
+		"""Decode bits in the packet
+
+		If the packet contains pulses that can't be explained with a
+		single clock (e.g. when two transmissions collide), the packet
+		is split and each part is decoded separately. Parts shorter
+		than MIN_SEGMENT_BITS are discarded.
+		"""
+		data = self.trim(self.data)
+
+		#print ''.join([str(i) for i in self.data]).replace('0', '.')
+		print ''.join([str(i) for i in data]).replace('0', '.')
 		
-		hd = iter('%x' % self.bits)
-		h = ' '.join(['%s%s' % i for i in zip(hd, hd)])
-		print 'data ', h
+		if len(self.data) < 50:
+			return False
+
+		pulses = self.pulses(data)
+
+		found = False
+		for segment in self.split_pulses(pulses):
+			while segment:
+				cp, n = self.adjust_clock(segment)
+
+				# decode bits
+				self.bits = 0
+				nbits = 0
+				for pv, pl, pt in segment[:n]:
+					r = pl / cp
+					for i in xrange(int(round(r))):
+						self.push_bit(pv)
+						nbits += 1
+
+				if (n == len(pulses)) or (nbits >= MIN_SEGMENT_BITS):
+					hd = iter('%x' % self.bits)
+					h = ' '.join(['%s%s' % i for i in zip(hd, hd)])
+					print 'start', self.start + segment[0][2]
+					print 'data ', h
+					found = True
+
+				# skip the inconsistent pulse and resynchronize
+				segment = segment[n+1:]
+
+		# the receiver timestamps packets when it reads them
+		sys.stdout.flush()
+		return found
 
 class Packetizer:
 	
-	def __init__(self):
+	def __init__(self, max_length=MAX_PACKET_LENGTH):
+		self.max_length = max_length
 		self.sample_cnt = 0
 		self.pv = 0
 		self.packet = None
 		self.data = ""
+
+		# statistics, see stats()
+		self.packets = 0
+		self.dropped = 0
+		self.longest = 0
 	
+	def stats(self):
+		"""Return a list of (name, value) tuples with packetizer statistics
+
+		packets -- number of packets passed on for decoding
+		dropped -- number of packets dropped for exceeding max_length
+		longest -- longest packet in samples since the last call
+		buffered -- samples in the currently open packet
+		"""
+		if self.packet is None:
+			buffered = 0
+		else:
+			buffered = len(self.packet.data)
+
+		stats = [
+			('packets', self.packets),
+			('dropped', self.dropped),
+			('longest', self.longest),
+			('buffered', buffered),
+		]
+
+		self.longest = 0
+		return stats
+
+	def _yielded(self, packet):
+		self.packets += 1
+		self.longest = max(self.longest, len(packet.data))
+
 	def feed(self, data):
 		self.data = self.data + data
 		
@@ -224,6 +302,8 @@ class Packetizer:
 			v = ord(self.data[i]) >= 190 and 1 or 0
 			
 			if v != self.pv:
+				if packet.start < 0:
+					packet.start = self.sample_cnt + i
 				inpacket = True
 				self.pv = v
 				packet.ntran += 1
@@ -241,17 +321,215 @@ class Packetizer:
 					if packet.data:
 						packet.data = packet.data[:-1]
 					if packet.data:
+						self._yielded(packet)
 						yield packet
 					self.packet = packet = Packet()
 					inpacket = False
+				elif len(packet.data) > self.max_length:
+					log('packet too long')
+					self.dropped += 1
+					self.packet = packet = Packet()
+					inpacket = False
 			
 			i += 1
+		self.sample_cnt += datalen
 		self.data = ''
 		
 
-def run_loop(fd):
+class RunPacketizer(Packetizer):
+	"""Packetizer for run-length encoded sample streams
+
+	Idle periods are processed in constant time per run. Samples are
+	only expanded for runs that are part of a packet.
+	"""
+
+	def __init__(self, max_length=MAX_PACKET_LENGTH):
+		Packetizer.__init__(self, max_length)
+		self.breaklen = 0
+
+	def _nextpacket(self):
+		nruns = len(self.data) / RUN_SIZE
+		records = struct.unpack('<%dI' % (nruns,), self.data[:nruns*RUN_SIZE])
+		self.data = self.data[nruns*RUN_SIZE:]
+
+		if self.packet is None:
+			self.packet = Packet()
+
+		packet = self.packet
+
+		for record in records:
+			v = record >> 31
+			length = record & RUN_MAX_LENGTH
+
+			if length == 0:
+				continue
+
+			if v != self.pv:
+				if packet.start < 0:
+					packet.start = self.sample_cnt
+				self.pv = v
+				packet.ntran += 1
+				self.breaklen = 0
+				packet.data.append(v)
+				rest = length - 1
+			else:
+				rest = length
+
+			self.sample_cnt += length
+
+			if not packet.data:
+				self.breaklen += rest
+				continue
+
+			need = MIN_BREAK + 1 - self.breaklen
+			if rest < need:
+				if len(packet.data) + rest > self.max_length:
+					log('packet too long')
+					self.dropped += 1
+					self.packet = packet = Packet()
+					self.breaklen += rest
+					continue
+
+				packet.data.extend([v] * rest)
+				self.breaklen += rest
+				continue
+
+			# trim break and return packet
+			packet.data.extend([v] * need)
+			self.breaklen += rest
+
+			packet.data = packet.data[:len(packet.data)-(MIN_BREAK+1)]
+			if packet.data:
+				packet.data = packet.data[:-1]
+			if packet.data:
+				self._yielded(packet)
+				yield packet
+			self.packet = packet = Packet()
+
+	def seek(self, fd, index, sample):
+		"""Seek to the last burst starting before sample
+
+		index -- list of (sample, offset) tuples, as written by
+		RunLengthEncoder
+		"""
+		n = bisect.bisect_right(index, (sample, sys.maxint))
+		if n == 0:
+			return
+
+		sample, offset = index[n-1]
+
+		fd.seek(offset)
+		record, = struct.unpack(RUN_FORMAT, fd.read(RUN_SIZE))
+		fd.seek(offset)
+
+		self.sample_cnt = sample
+		self.pv = 1 - (record >> 31)
+		self.breaklen = MIN_BREAK + 1
+		self.packet = None
+		self.data = ""
+
+class RunLengthEncoder:
+	"""Run-length encoder for raw baseband samples
+
+	index -- list of (sample, offset) tuples, one for each burst
+	following a break longer than MIN_BREAK samples. sample is the
+	index of the first burst sample and offset is the position of its
+	record in the encoded stream.
+	"""
+
+	def __init__(self):
+		self.value = 0
+		self.length = 0
+
+		self.sample_cnt = 0
+		self.offset = 0
+
+		self.last_value = 0
+		self.last_length = MIN_BREAK + 1
+
+		self.index = []
+
+	def feed(self, data):
+		"""Returns encoded data for runs that ended in data"""
+		out = []
+		for v, group in itertools.groupby(data, lambda c: ord(c) >= 190):
+			v = int(v)
+			length = sum(1 for c in group)
+
+			if v == self.value:
+				self.length += length
+			else:
+				out += self._emit()
+				self.value = v
+				self.length = length
+
+		return ''.join(out)
+
+	def flush(self):
+		"""Returns encoded data for the last run"""
+		out = self._emit()
+		self.length = 0
+		return ''.join(out)
+
+	def _emit(self):
+		out = []
+		if self.value != self.last_value:
+			if self.last_length > MIN_BREAK:
+				self.index.append((self.sample_cnt, self.offset))
+			self.last_value = self.value
+			self.last_length = 0
+
+		self.last_length += self.length
+
+		while self.length > 0:
+			length = min(self.length, RUN_MAX_LENGTH)
+			out.append(struct.pack(RUN_FORMAT, (self.value << 31) | length))
+
+			self.sample_cnt += length
+			self.offset += RUN_SIZE
+			self.length -= length
+
+		return out
+
+def write_index(path, index):
+	f = open(path, 'w')
+	try:
+		for sample, offset in index:
+			f.write("%d %d\n" % (sample, offset))
+	finally:
+		f.close()
+
+def read_index(path):
+	return [ tuple(int(field) for field in line.split()) for line in open(path) ]
+
+def encode_loop(fd, path):
+
+	encoder = RunLengthEncoder()
+
+	out = open(path, 'wb')
+	try:
+		data = fd.read(BUFFSIZE)
+		while data:
+			out.write(encoder.feed(data))
+			data = fd.read(BUFFSIZE)
+
+		out.write(encoder.flush())
+	finally:
+		out.close()
+
+	write_index(path + ".idx", encoder.index)
+
+def print_stats(packetizer):
+	print 'stats', ' '.join('%s %d' % stat for stat in packetizer.stats())
+	sys.stdout.flush()
+
+def run_loop(fd, packetizer=None, stats_interval=None):
 	
-	packetizer = Packetizer()
+	if packetizer is None:
+		packetizer = Packetizer()
+
+	if stats_interval is not None:
+		next_stats = time.time() + stats_interval
 
 	data = fd.read(BUFFSIZE)
 	readlen = len(data)
@@ -261,6 +539,10 @@ def run_loop(fd):
 		for packet in packetizer.feed(data):
 			packet.recover_clock()
 			#print packet
+
+		if (stats_interval is not None) and (time.time() >= next_stats):
+			print_stats(packetizer)
+			next_stats = time.time() + stats_interval
 		
 		data = fd.read(BUFFSIZE)
 		readlen = len(data)
@@ -275,6 +557,17 @@ def main():
 			help="read baseband data from FILE")
 	parser.add_option("-v", dest="verbose", action="store_true",
 			help="enable verbose decoder debug output on stderr")
+	parser.add_option("-m", dest="max_length", metavar="SAMPLES", type="int",
+			default=MAX_PACKET_LENGTH,
+			help="drop packets longer than SAMPLES (default %default)")
+	parser.add_option("-r", dest="rle", action="store_true",
+			help="input is run-length encoded")
+	parser.add_option("-e", dest="encode", metavar="FILE",
+			help="run-length encode input into FILE and write burst index to FILE.idx")
+	parser.add_option("-s", dest="seek", metavar="SAMPLE", type="int",
+			help="start decoding at the burst before SAMPLE (requires -r and FILE.idx)")
+	parser.add_option("-i", dest="stats_interval", metavar="SECONDS", type="float",
+			help="print a line with packetizer statistics every SECONDS")
 
 	(options, args) = parser.parse_args()
 
@@ -285,7 +578,21 @@ def main():
 
 	verbose = options.verbose
 
-	run_loop(fd)
+	if options.encode:
+		encode_loop(fd, options.encode)
+		return
+
+	if options.rle:
+		packetizer = RunPacketizer(options.max_length)
+		if options.seek is not None:
+			if not options.input:
+				parser.error("-s requires -f")
+			index = read_index(options.input + ".idx")
+			packetizer.seek(fd, index, options.seek)
+	else:
+		packetizer = Packetizer(options.max_length)
+
+	run_loop(fd, packetizer, options.stats_interval)
 
 
 if __name__ == "__main__":
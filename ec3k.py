@@ -17,17 +17,32 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from gnuradio import digital
 from gnuradio import gr, blocks, filter, analog
 
+import binascii
+import collections
+import gc
+import inspect
 import itertools
+import json
 import math
+import multiprocessing
+import numpy
 import os.path
 import osmosdr
 import select
+import shutil
 import signal
+import socket
+import struct
 import subprocess
 import tempfile
 import threading
 import time
 
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
 def which(program):
 	for path in os.environ["PATH"].split(os.pathsep):
 		fpath = os.path.join(path, program)
@@ -38,6 +53,77 @@ def which(program):
 
 class InvalidPacket(Exception): pass
 
+class DecodePlan:
+	"""Field extraction plan compiled from a packet layout table
+
+	fields -- list of (name, ranges) tuples. ranges is a list of
+	(start, end) nibble index ranges, most significant first, that
+	are concatenated into the field value.
+
+	padding -- list of (start, end) nibble ranges that must be zero.
+
+	length -- packet payload length in nibbles.
+
+	Fields are extracted from the payload given as a single integer
+	using only shifts and bit masks. extract(payload) returns a
+	dictionary of field values. It is compiled from the layout into a
+	single expression, so no loops run when decoding a packet.
+	"""
+	def __init__(self, fields, padding, length):
+		self.fields = []
+		for name, ranges in fields:
+			segments = []
+			out_shift = 0
+			for start, end in reversed(ranges):
+				segments.append((self._shift(length, end), self._mask(start, end), out_shift))
+				out_shift += 4 * (end - start)
+
+			self.fields.append((name, segments))
+
+		self.padding = [ (self._shift(length, end), self._mask(start, end))
+				for start, end in padding ]
+
+		self.padding_mask = 0
+		for shift, mask in self.padding:
+			self.padding_mask |= mask << shift
+
+		expressions = []
+		for name, segments in self.fields:
+			terms = [ "((payload >> %d) & 0x%x) << %d" % segment for segment in segments ]
+			expressions.append("%r: %s" % (name, " | ".join(terms)))
+
+		self.extract = eval("lambda payload: {%s}" % (", ".join(expressions),))
+
+	def _shift(self, length, end):
+		return 4 * (length - end)
+
+	def _mask(self, start, end):
+		return (1 << (4 * (end - start))) - 1
+
+	def extract_padding(self, payload):
+		"""Returns a list of padding values"""
+		return [ (payload >> shift) & mask for shift, mask in self.padding ]
+
+# Layout of the 41 byte (82 nibble) packet payload covered by the CRC.
+#
+#	nibbles[45:59]	unknown
+#	nibbles[78:82]	crc
+#	nibbles[82:84]	end mark (not covered by the CRC)
+PACKET_FIELDS = [
+	('start_mark',		[ ( 0, 1) ]),
+	('id',			[ ( 1, 5) ]),
+	('time_total',		[ (59,62), ( 5, 9) ]),
+	('time_on',		[ (71,74), (13,17) ]),
+	('energy',		[ (67,71), (24,31) ]),
+	('power_current',	[ (31,35) ]),
+	('power_max',		[ (35,39) ]),
+	('energy_2',		[ (39,45) ]),
+	('reset_counter',	[ (74,76) ]),
+	('flags',		[ (76,77) ]),
+]
+
+PACKET_PADDING = [ ( 9,13), (17,24), (62,67), (77,78) ]
+
 class EnergyCount3KState:
 	"""EnergyCount 3000 transmitter state.
 
@@ -58,28 +144,91 @@ class EnergyCount3KState:
 
 	device_on_flag -- true if device is currently drawing non-zero power
 
-	timestamp -- UNIX timestamp of the packet reception (not accurate)
+	timestamp -- UNIX timestamp of the packet reception
+	latency -- time in seconds from packet reception to the end of decoding
 	"""
 	
 	CRC = 0xf0b8
 
-	def __init__(self, hex_bytes):
-		bits = self._get_bits(hex_bytes)
+	PLAN = DecodePlan(PACKET_FIELDS, PACKET_PADDING, 82)
+
+	FIELDS = [	'id',
+			'device_on_flag',
+			'energy',
+			'power_current',
+			'power_max',
+			'time_on',
+			'time_total' ]
+
+	def __init__(self, hex_bytes, timestamp=None, frame_bits=None):
+		"""Decode a packet
+
+		hex_bytes -- list of packet bytes, printed in hex
+		timestamp -- UNIX timestamp of the packet reception. If None,
+		current time is used.
+		frame_bits -- descrambled bits of a single frame to decode
+		instead of hex_bytes (see decode_burst())
+		"""
+		if timestamp is None:
+			timestamp = time.time()
+
+		self.timestamp = timestamp
+
+		if frame_bits is None:
+			frame_bits = self._descramble(hex_bytes)
+
+		bits = self._bit_unstuff(frame_bits)
+
+		bits = self._bit_shuffle(bits)
+
+		if len(bits) != 336:
+			raise InvalidPacket("Wrong length: %d" % (len(bits) / 4,))
+
+		packet = self._get_int(bits)
+
+		self._check_crc(packet)
+
+		# strip end mark
+		self._decode_packet(packet >> 8)
+
+		self.latency = time.time() - self.timestamp
+
+	@staticmethod
+	def _descramble(hex_bytes):
+		"""Unpacks hex printed data into descrambled bits"""
+		bits = EnergyCount3KState._get_bits(hex_bytes)
 		bits = [ not bit for bit in bits ]
 
-		bits = self._descrambler([18, 17, 13, 12, 1], bits)
+		bits = EnergyCount3KState._descrambler([18, 17, 13, 12, 1], bits)
 		bits = [ not bit for bit in bits ]
-		
-		bits = self._bit_unstuff(bits)
 
-		bits = self._bit_shuffle(bits)
+		return bits
 
-		nibbles = self._get_nibbles(bits)
+	@staticmethod
+	def _find_frames(bits):
+		"""Find all flag delimited frames in descrambled bits
 
-		self._check_crc(nibbles)
-		self._decode_packet(nibbles)
+		Returns a list of bit lists, each containing a candidate frame
+		together with its opening and closing flag. Frames between
+		any two consecutive flags are returned, so the list also
+		contains gaps between frames and frames with corrupted contents.
+		"""
+		# indexes of zeros that terminate a run of exactly 6 ones
+		flags = []
 
-	def _get_bits(self, hex_bytes):
+		cnt = 0
+		for n, bit in enumerate(bits):
+			if bit:
+				cnt += 1
+			else:
+				if cnt == 6:
+					flags.append(n)
+				cnt = 0
+
+		return [ bits[start-6:end+1] for start, end in zip(flags, flags[1:]) ]
+
+	@staticmethod
+	def _get_bits(hex_bytes):
 		"""Unpacks hex printed data into individual bits"""
 		bits = []
 
@@ -90,13 +239,9 @@ class EnergyCount3KState:
 
 		return bits
 
-	def _get_nibbles(self, bits):
-		"""Shift bits into bytes, MSB first"""
-		nibbles = [0] * (len(bits) / 4)
-		for n, bit in enumerate(bits):
-			nibbles[n/4] |= (int(bit) << (3-n%4))
-
-		return nibbles
+	def _get_int(self, bits):
+		"""Shift bits into an integer, MSB first"""
+		return int("".join(map("01".__getitem__, bits)), 2)
 
 	def _bit_shuffle(self, bits):
 		"""Weird bit shuffling operation required"""
@@ -109,7 +254,8 @@ class EnergyCount3KState:
 
 		return nbits
 
-	def _descrambler(self, taps, bits):
+	@staticmethod
+	def _descrambler(taps, bits):
 		"""Multiplicative, self-synchronizing scrambler"""
 		nbits = []
 
@@ -168,73 +314,44 @@ class EnergyCount3KState:
 
 		return ((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)
 
-	def _check_crc(self, nibbles):
-		if len(nibbles) != 84:
-			raise InvalidPacket("Wrong length: %d" % len(nibbles))
+	def _check_crc(self, packet):
+		# 41 bytes covered by the CRC, followed by the end mark
+		data = bytearray(binascii.unhexlify("%084x" % (packet,)))
 
 		crc = 0xffff
-		for i in xrange(0, 82, 2):
-			crc = self._crc_ccitt_update(crc, nibbles[i] * 0x10 + nibbles[i+1])
+		for i in xrange(41):
+			crc = self._crc_ccitt_update(crc, data[i])
 
 		if crc != self.CRC:
 			raise InvalidPacket("CRC mismatch: %d != %d" % (crc, self.CRC))
 
-	def _unpack_int(self, nibbles):
-		i = 0
-		for nibble in nibbles:
-			i = (i * 0x10) + nibble
+	def _decode_packet(self, payload):
 
-		return i
+		fields = self.PLAN.extract(payload)
 
-	def _decode_packet(self, nibbles):
-
-		start_mark		= self._unpack_int(	nibbles[ 0: 1])
+		start_mark = fields['start_mark']
 		if start_mark != 0x9:
 			raise InvalidPacket("Unknown start mark: 0x%x (please report this)" % (start_mark,))
 
-		self.id			= self._unpack_int(	nibbles[ 1: 5])
-		time_total_low 		= 			nibbles[ 5: 9]
-		pad_1			= self._unpack_int(	nibbles[ 9:13])
-		time_on_low		= 			nibbles[13:17]
-		pad_2 			= self._unpack_int(	nibbles[17:24])
-		energy_low		= 			nibbles[24:31]
-		self.power_current	= self._unpack_int(	nibbles[31:35]) / 10.0
-		self.power_max		= self._unpack_int(	nibbles[35:39]) / 10.0
-		# unknown? (seems to be used for internal calculations)
-		self.energy_2		= self._unpack_int(	nibbles[39:45])
-		# 						nibbles[45:59]
-		time_total_high		=			nibbles[59:62]
-		pad_3			= self._unpack_int(	nibbles[62:67])
-		energy_high		=			nibbles[67:71]
-		time_on_high		=			nibbles[71:74]
-		self.reset_counter	= self._unpack_int(	nibbles[74:76])
-		flags			= self._unpack_int(	nibbles[76:77])
-		pad_4			= self._unpack_int(	nibbles[77:78])
-		# crc			= self._unpack_int(	nibbles[78:82])
-
 		# We don't really care about the end mark, or whether it got
 		# corrupted, since it's not covered by the CRC check.
 
-		#end_mark		= self._unpack_int(	nibbles[82:84])
-		#if end_mark != 0x7e:
-		#	raise InvalidPacket("Invalid end mark: %d" % (end_mark,))
-
-		if pad_1 != 0:
-			raise InvalidPacket("Padding 1 not zero: 0x%x (please report this)" % (pad_1,))
-		if pad_2 != 0:
-			raise InvalidPacket("Padding 2 not zero: 0x%x (please report this)" % (pad_2,))
-		if pad_3 != 0:
-			raise InvalidPacket("Padding 3 not zero: 0x%x (please report this)" % (pad_3,))
-		if pad_4 != 0:
-			raise InvalidPacket("Padding 4 not zero: 0x%x (please report this)" % (pad_4,))
-
-		self.timestamp		= time.time()
-
-		self.time_total	= self._unpack_int(time_total_high + time_total_low)
-		self.time_on	= self._unpack_int(time_on_high + time_on_low)
-
-		self.energy	= self._unpack_int(energy_high + energy_low)
+		if payload & self.PLAN.padding_mask:
+			for n, pad in enumerate(self.PLAN.extract_padding(payload)):
+				if pad != 0:
+					raise InvalidPacket("Padding %d not zero: 0x%x (please report this)" % (n+1, pad))
+
+		self.id			= fields['id']
+		self.time_total		= fields['time_total']
+		self.time_on		= fields['time_on']
+		self.energy		= fields['energy']
+		self.power_current	= fields['power_current'] / 10.0
+		self.power_max		= fields['power_max'] / 10.0
+		# unknown? (seems to be used for internal calculations)
+		self.energy_2		= fields['energy_2']
+		self.reset_counter	= fields['reset_counter']
 
+		flags = fields['flags']
 		if flags == 0x8:
 			self.device_on_flag = True
 		elif flags == 0x0:
@@ -249,6 +366,16 @@ class EnergyCount3KState:
 		self.current_power = self.power_current
 		self.max_power = self.power_max
 
+	def to_dict(self, fields=None):
+		"""Return decoded fields as a dictionary
+
+		fields -- list of attributes to include (default is FIELDS)
+		"""
+		if fields is None:
+			fields = self.FIELDS
+
+		return dict((field, getattr(self, field)) for field in fields)
+
 	def __str__(self):
 		if self.device_on_flag:
 			flag = '*'
@@ -270,9 +397,241 @@ class EnergyCount3KState:
 					self.power_max,
 					self.reset_counter)
 
+def sample_timestamp(stream_start, sample, samp_rate):
+	"""Convert a sample index reported by the capture process into an
+	UNIX timestamp
+
+	stream_start -- UNIX timestamp of the first sample
+	samp_rate -- sample rate of the stream
+
+	This assumes that no samples were dropped between the radio and the
+	capture process and that the radio clock matches the system clock.
+	Otherwise the error grows with the sample index.
+	"""
+	return stream_start + float(sample) / samp_rate
+
+def decode_burst(hex_bytes, timestamp=None):
+	"""Decode all packets in a burst of data
+
+	A burst may contain several back-to-back frames or frames
+	corrupted by a collision with another transmission. Frames are
+	located using flags that delimit them and each one is decoded
+	separately.
+
+	Returns a list of EnergyCount3KState objects. Raises InvalidPacket
+	if no valid packet was found.
+	"""
+	bits = EnergyCount3KState._descramble(hex_bytes)
+
+	states = []
+	error = InvalidPacket("No frames found")
+
+	for frame_bits in EnergyCount3KState._find_frames(bits):
+		try:
+			states.append(EnergyCount3KState(None, timestamp, frame_bits))
+		except InvalidPacket, e:
+			error = e
+
+	if not states:
+		raise error
+
+	return states
+
+class DeviceSchedule:
+	"""Learned transmission schedule of a single device
+
+	id -- 16-bit ID of the device
+	period -- estimated time between transmissions in seconds
+	last_timestamp -- reception time of the last packet
+	last_time_total -- time_total field of the last packet
+	received -- number of received packets
+	missed -- number of packets that were expected but not received
+	"""
+	def __init__(self, id, period):
+		self.id = id
+		self.period = period
+
+		self.last_timestamp = None
+		self.last_time_total = None
+
+		self.received = 0
+		self.missed = 0
+
+	def update(self, state, alpha):
+		if (self.last_time_total is not None) and (state.time_total > self.last_time_total):
+			# time_total is not affected by reception jitter, so
+			# use it to count transmissions since the last packet.
+			dtt = state.time_total - self.last_time_total
+			n = max(1, int(round(dtt / self.period)))
+
+			dt = state.timestamp - self.last_timestamp
+			self.period = (1.0 - alpha) * self.period + alpha * dt / n
+
+			self.missed += n - 1
+
+		self.last_timestamp = state.timestamp
+		self.last_time_total = state.time_total
+		self.received += 1
+
+	def next_arrival(self, timestamp):
+		"""Returns predicted arrival time nearest to timestamp"""
+		n = max(1, int(round((timestamp - self.last_timestamp) / self.period)))
+		return self.last_timestamp + n * self.period
+
+	def loss(self):
+		"""Returns the ratio of lost packets"""
+		total = self.received + self.missed
+		if total:
+			return float(self.missed) / total
+		else:
+			return 0.0
+
+class TransmissionScheduler:
+	"""Predicts transmissions of known devices
+
+	Pass an instance to EnergyCount3K or EnergyCount3KSupervisor to
+	learn transmission period and phase of each device from received
+	packets. Learned schedules and
+	per-device packet loss statistics are in the devices dictionary.
+
+	window -- time in seconds around a predicted arrival in which a
+	packet is expected
+	alpha -- weight of new measurements in the period estimate
+	gate -- if True, the receiver only searches bursts that fail to
+	decode as a single packet for additional frames (see decode_burst())
+	when a known device is expected
+	max_devices -- maximum number of devices to track. When exceeded,
+	the device that was not heard from for the longest time is dropped.
+	max_missed -- stop predicting transmissions of a device after this
+	many consecutive transmissions were missed
+	"""
+
+	DEFAULT_PERIOD = 5.0
+
+	def __init__(self, window=1.0, alpha=0.1, gate=False, max_devices=1024, max_missed=3):
+		self.window = window
+		self.alpha = alpha
+		self.gate = gate
+		self.max_devices = max_devices
+		self.max_missed = max_missed
+
+		self.devices = {}
+
+	def update(self, state):
+		"""Update schedule with a received EnergyCount3KState object"""
+		device = self.devices.get(state.id)
+		if device is None:
+			if len(self.devices) >= self.max_devices:
+				oldest = min(self.devices.itervalues(), key=lambda d: d.last_timestamp)
+				del self.devices[oldest.id]
+
+			device = self.devices[state.id] = DeviceSchedule(state.id, self.DEFAULT_PERIOD)
+
+		device.update(state, self.alpha)
+
+	def predict(self, id):
+		"""Returns predicted time of the next transmission of a device"""
+		device = self.devices[id]
+		return device.last_timestamp + device.period
+
+	def expected(self, timestamp):
+		"""Returns a list of IDs of devices expected to transmit at timestamp"""
+		return [ device.id for device in self.devices.itervalues()
+				if (timestamp - device.last_timestamp <=
+					self.max_missed * device.period + self.window)
+				and (abs(device.next_arrival(timestamp) - timestamp) <= self.window) ]
+
+	def overdue(self, timestamp=None):
+		"""Returns a list of IDs of devices that missed their last transmission"""
+		if timestamp is None:
+			timestamp = time.time()
+
+		return [ device.id for device in self.devices.itervalues()
+				if timestamp > device.last_timestamp + device.period + self.window ]
+
+def encode_runs(samples, value, length, flush_length):
+	"""Run-length encode an array of 0/1 samples
+
+	value, length -- run left open by the previous call
+	flush_length -- emit the open run when it gets this long
+
+	Returns a (records, value, length) tuple, where records is an array of
+	32-bit records in the format read by "capture.py -r" and (value,
+	length) is the run left open at the end of samples.
+	"""
+	if len(samples) == 0:
+		return numpy.zeros(0, dtype=numpy.uint32), value, length
+
+	starts = numpy.concatenate(([0], numpy.flatnonzero(samples[1:] != samples[:-1]) + 1))
+	lengths = numpy.diff(numpy.concatenate((starts, [len(samples)]))).astype(numpy.uint32)
+	values = samples[starts].astype(numpy.uint32)
+
+	if values[0] == value:
+		lengths[0] += length
+	elif length > 0:
+		values = numpy.concatenate(([value], values)).astype(numpy.uint32)
+		lengths = numpy.concatenate(([length], lengths)).astype(numpy.uint32)
+
+	value = int(values[-1])
+	length = int(lengths[-1])
+
+	values = values[:-1]
+	lengths = lengths[:-1]
+
+	# don't hold idle periods back, otherwise the packetizer can't
+	# see the end of the last packet.
+	if length >= flush_length:
+		values = numpy.concatenate((values, [value])).astype(numpy.uint32)
+		lengths = numpy.concatenate((lengths, [length])).astype(numpy.uint32)
+		length = 0
+
+	records = (values << 31) | lengths
+	return records, value, length
+
+class RunLengthEncoderBlock(gr.basic_block):
+	"""GNU Radio block that run-length encodes binary slicer output"""
+
+	RUN_SIZE = 4
+
+	def __init__(self, flush_length=1000):
+		gr.basic_block.__init__(self,
+				name="ec3k_run_length_encoder",
+				in_sig=[numpy.uint8],
+				out_sig=[numpy.uint8])
+
+		self.flush_length = flush_length
+		self.value = 0
+		self.length = 0
+
+	def forecast(self, noutput_items, ninput_items_required):
+		ninput_items_required[0] = max(1, noutput_items / self.RUN_SIZE)
+
+	def general_work(self, input_items, output_items):
+		out = output_items[0]
+
+		# every sample produces at most one record, plus one for the
+		# run left open by the previous call.
+		n = min(len(input_items[0]), len(out) / self.RUN_SIZE - 1)
+		if n <= 0:
+			return 0
+
+		records, self.value, self.length = encode_runs(input_items[0][:n],
+				self.value, self.length, self.flush_length)
+
+		data = records.astype('<u4').view(numpy.uint8)
+		out[:len(data)] = data
+
+		self.consume(0, n)
+		return len(data)
+
 class EnergyCount3K:
 	"""Object representing EnergyCount 3000 receiver"""
-	def __init__(self, id=None, callback=None, freq=868.402e6, device=0, osmosdr_args=None):
+
+	SAMP_RATE = 96000
+
+	def __init__(self, id=None, callback=None, freq=868.402e6, device=0, osmosdr_args=None,
+			scheduler=None, rle=False, diagnostics=None, max_length=None,
+			clock_tolerance=1.0):
 		"""Create a new EnergyCount3K object
 
 		Takes the following optional keyword arguments:
@@ -282,6 +641,19 @@ class EnergyCount3K:
 		updates (default is known to work for European devices)
 		device -- rtl-sdr device to use
 		osmosdr_args -- any additional OsmoSDR arguments (e.g. "offset_tune=1")
+		scheduler -- TransmissionScheduler object to update with received
+		packets
+		rle -- pass baseband to the capture process run-length encoded
+		(requires capture.py)
+		diagnostics -- Diagnostics object to run while the receiver is
+		running. Its reports include packetizer statistics of the
+		capture process (requires capture.py).
+		max_length -- longest burst in samples the capture process keeps
+		in memory (requires capture.py, default is capture.py's
+		MAX_PACKET_LENGTH)
+		clock_tolerance -- largest difference in seconds allowed between
+		reception times derived from the sample count and the system
+		clock (see _sample_timestamp())
 
 		If ID is None, then packets for all devices will be received.
 
@@ -293,6 +665,11 @@ class EnergyCount3K:
 		self.freq = freq
 		self.device = device
 		self.osmosdr_args = osmosdr_args
+		self.scheduler = scheduler
+		self.rle = rle
+		self.diagnostics = diagnostics
+		self.max_length = max_length
+		self.clock_tolerance = clock_tolerance
 
 		self.want_stop = True
 		self.state = None
@@ -307,12 +684,30 @@ class EnergyCount3K:
 
 		self._start_capture()
 
-		capture_thread = threading.Thread(target=self._capture_thread)
-		capture_thread.start()
-		self.threads.append(capture_thread)
+		try:
+			capture_thread = threading.Thread(target=self._capture_thread)
+			capture_thread.start()
+			self.threads.append(capture_thread)
+
+			self._setup_top_block()
 
-		self._setup_top_block()
-		self.tb.start()
+			# sample counts reported by the capture process are relative
+			# to this time. Take it after the device has started.
+			self.stream_start = None
+			self.tb.start()
+			self.stream_start = time.time()
+		except:
+			# e.g. no rtl-sdr device. Don't leave the capture process
+			# waiting on the pipe.
+			self.want_stop = True
+			for thread in self.threads:
+				thread.join()
+
+			self._clean_capture()
+			raise
+
+		if self.diagnostics is not None:
+			self.diagnostics.start()
 
 	def stop(self):
 		"""Stop the receiver and clean up"""
@@ -320,6 +715,9 @@ class EnergyCount3K:
 
 		self.want_stop = True
 
+		if self.diagnostics is not None:
+			self.diagnostics.stop()
+
 		for thread in self.threads:
 			thread.join()
 
@@ -347,12 +745,27 @@ class EnergyCount3K:
 
 		self.capture_process = None
 
+		programs = ["capture", "capture.py"]
+		args = []
+
+		# C implementation doesn't support run-length encoding,
+		# limiting packet length or statistics
+		if self.rle:
+			programs = ["capture.py"]
+			args += ["-r"]
+		if self.max_length is not None:
+			programs = ["capture.py"]
+			args += ["-m", str(self.max_length)]
+		if self.diagnostics is not None:
+			programs = ["capture.py"]
+			args += ["-i", str(self.diagnostics.interval)]
+
 		try:
-			for program in ["capture", "capture.py"]:
+			for program in programs:
 				fpath = which(program)
 				if fpath is not None:
 					self.capture_process = subprocess.Popen(
-						[fpath, "-f", self.pipe],
+						[fpath, "-f", self.pipe] + args,
 						bufsize=1,
 						stdout=subprocess.PIPE)
 					return
@@ -371,26 +784,88 @@ class EnergyCount3K:
 		os.unlink(self.pipe)
 		os.rmdir(self.tempdir)
 
+	def _sample_timestamp(self, sample, now=None):
+		"""Convert a sample index into a reception timestamp
+
+		now -- time the packet was read from the capture process
+
+		Dropped samples and radio clock drift make the sample count fall
+		behind or run ahead of the system clock. If the result is later
+		than now or more than clock_tolerance earlier, the stream is
+		re-anchored so that the sample maps to now. Timestamps are
+		therefore never later than the packet was read and at most
+		clock_tolerance earlier than that.
+		"""
+		if now is None:
+			now = time.time()
+
+		if self.stream_start is None:
+			self.stream_start = now - float(sample) / self.SAMP_RATE
+
+		timestamp = sample_timestamp(self.stream_start, sample, self.SAMP_RATE)
+		if (timestamp > now) or (now - timestamp > self.clock_tolerance):
+			self._log("Sample clock off by %.3f s, re-anchoring" % (timestamp - now,))
+			self.stream_start += now - timestamp
+			timestamp = now
+
+		return timestamp
+
+	def _decode(self, hex_bytes, timestamp):
+		if (self.scheduler is None) or (not self.scheduler.gate):
+			return decode_burst(hex_bytes, timestamp)
+
+		try:
+			return [ EnergyCount3KState(hex_bytes, timestamp) ]
+		except InvalidPacket:
+			if timestamp is None:
+				timestamp = time.time()
+
+			if not self.scheduler.expected(timestamp):
+				raise
+
+			return decode_burst(hex_bytes, timestamp)
+
 	def _capture_thread(self):
 
+		# index of the first sample of the next packet, if the
+		# capture process reports it
+		start = None
+
 		while not self.want_stop:
 
 			rlist, wlist, xlist = select.select([self.capture_process.stdout], [], [], 1)
 			if rlist:
 				line = rlist[0].readline()
 				fields = line.split()
-				if fields and (fields[0] == 'data'):
+				if fields and (fields[0] == 'start'):
+					start = int(fields[1])
+				elif fields and (fields[0] == 'stats'):
+					# name value pairs
+					stats = dict(zip(fields[1::2], map(int, fields[2::2])))
+					if self.diagnostics is not None:
+						self.diagnostics.update('capture', stats)
+				elif fields and (fields[0] == 'data'):
+					if start is not None:
+						timestamp = self._sample_timestamp(start)
+						start = None
+					else:
+						timestamp = None
+
 					self._log("Decoding packet")
 					try:
-						state = EnergyCount3KState(fields[1:])
+						states = self._decode(fields[1:], timestamp)
 					except InvalidPacket, e:
 						self._log("Invalid packet: %s" % (e,))
 						continue
 
-					if (not self.id) or (state.id == self.id):
-						self.state = state
-						if self.callback:
-							self.callback(self.state)
+					for state in states:
+						if self.scheduler is not None:
+							self.scheduler.update(state)
+
+						if (not self.id) or (state.id == self.id):
+							self.state = state
+							if self.callback:
+								self.callback(self.state)
 
 	def _noise_probe_thread(self):
 		while not self.want_stop:
@@ -406,7 +881,7 @@ class EnergyCount3K:
 
 		self.tb = gr.top_block()
 
-		samp_rate = 96000
+		samp_rate = self.SAMP_RATE
 		oversample = 10
 
 		# Radio receiver, initial downsampling
@@ -449,18 +924,774 @@ class EnergyCount3K:
 
 		binary_slicer = digital.binary_slicer_fb()
 
+		pipe_sink = blocks.file_sink(gr.sizeof_char*1, self.pipe)
+		pipe_sink.set_unbuffered(False)
+
+		self.tb.connect((quadrature_demod, 0), (add_offset, 0))
+		self.tb.connect((add_offset, 0), (binary_slicer, 0))
+
+		if self.rle:
+			run_length_encoder = RunLengthEncoderBlock()
+
+			self.tb.connect((binary_slicer, 0), (run_length_encoder, 0))
+			self.tb.connect((run_length_encoder, 0), (pipe_sink, 0))
+			return
+
 		char_to_float = blocks.char_to_float(1, 1)
 
 		multiply_const = blocks.multiply_const_vff((255, ))
 
 		float_to_uchar = blocks.float_to_uchar()
 
-		pipe_sink = blocks.file_sink(gr.sizeof_char*1, self.pipe)
-		pipe_sink.set_unbuffered(False)
-
-		self.tb.connect((quadrature_demod, 0), (add_offset, 0))
-		self.tb.connect((add_offset, 0), (binary_slicer, 0))
 		self.tb.connect((binary_slicer, 0), (char_to_float, 0))
 		self.tb.connect((char_to_float, 0), (multiply_const, 0))
 		self.tb.connect((multiply_const, 0), (float_to_uchar, 0))
 		self.tb.connect((float_to_uchar, 0), (pipe_sink, 0))
+
+def _supervised_receiver(conn, receiver_class, kwargs, report_interval, tempdir,
+		diagnostics_interval):
+	"""Entry point for the receiver process started by EnergyCount3KSupervisor"""
+
+	# the supervisor kills the whole process group, including the
+	# capture process, and removes tempdir if this process doesn't stop.
+	os.setpgrp()
+	tempfile.tempdir = tempdir
+
+	lock = threading.Lock()
+
+	def send(msg):
+		with lock:
+			conn.send(msg)
+
+	def callback(state):
+		send(('state', state))
+
+	def diagnostics_callback(report):
+		send(('diagnostics', report))
+
+	if diagnostics_interval is not None:
+		kwargs = dict(kwargs)
+		kwargs['diagnostics'] = Diagnostics(diagnostics_interval, diagnostics_callback)
+
+	receiver = receiver_class(callback=callback, **kwargs)
+	receiver.start()
+
+	while not conn.poll(report_interval):
+		send(('noise', receiver.noise_level))
+
+	receiver.stop()
+
+class EnergyCount3KSupervisor:
+	"""EnergyCount 3000 receiver running in a supervised child process
+
+	The GNU Radio flow graph and the capture process run in a separate
+	process. Decoded states are sent to this process over a pipe. If the
+	receiver process dies, the noise level stays at -90 dB (flow graph not
+	set up correctly) or no packets are received for some time, the
+	receiver process is killed and restarted. Last received states and
+	the callback are kept in this process across restarts.
+
+	The first restart happens immediately. If no packet is received after
+	a restart, each following restart is delayed twice as long as the
+	previous one, up to backoff_max seconds.
+	"""
+	def __init__(self, callback=None, stall_timeout=30.0, packet_timeout=60.0,
+			stop_timeout=5.0, max_restarts=100, backoff_min=1.0, backoff_max=60.0,
+			max_devices=1024, diagnostics=None, scheduler=None, receiver_class=None,
+			**kwargs):
+		"""Create a new EnergyCount3KSupervisor object
+
+		Takes the following optional keyword arguments:
+		callback -- callable to call for each received packet
+		stall_timeout -- restart if noise level stays at -90 dB for this
+		many seconds
+		packet_timeout -- restart if no packets are received for this many
+		seconds (None disables the check)
+		stop_timeout -- time in seconds to wait for the receiver process
+		to stop before killing it
+		max_restarts -- number of most recent restarts to keep in the
+		restarts attribute
+		backoff_min, backoff_max -- shortest and longest delay in seconds
+		between consecutive restarts
+		max_devices -- maximum number of devices to keep in the states
+		dictionary. When exceeded, the device that was not heard from for
+		the longest time is dropped.
+		diagnostics -- Diagnostics object to run in this process while
+		the receiver is running. The receiver process runs its own
+		Diagnostics with the same interval and its reports are passed
+		to the callback of this one.
+		scheduler -- TransmissionScheduler object to update in this
+		process with received packets. If gating is enabled, a copy is
+		passed to each new receiver process.
+
+		Other keyword arguments are passed to the EnergyCount3K
+		constructor in the receiver process.
+		"""
+		self.callback = callback
+		self.stall_timeout = stall_timeout
+		self.packet_timeout = packet_timeout
+		self.stop_timeout = stop_timeout
+		self.backoff_min = backoff_min
+		self.backoff_max = backoff_max
+		self.max_devices = max_devices
+		self.diagnostics = diagnostics
+		self.scheduler = scheduler
+
+		self.backoff = 0
+		self.process = None
+		self.tempdir = None
+
+		if receiver_class is None:
+			receiver_class = EnergyCount3K
+		self.receiver_class = receiver_class
+		self.kwargs = kwargs
+
+		self.want_stop = True
+		self.state = None
+		self.states = {}
+		self.noise_level = -90
+
+		# list of (reason, failure time, recovery time) tuples. Recovery
+		# time is None until the first packet after restart is received.
+		self.restarts = collections.deque(maxlen=max_restarts)
+
+	def start(self):
+		"""Start the receiver"""
+		assert self.want_stop
+
+		self.want_stop = False
+
+		self._start_receiver()
+
+		self.thread = threading.Thread(target=self._supervisor_thread)
+		self.thread.start()
+
+		if self.diagnostics is not None:
+			self.diagnostics.start()
+
+	def stop(self):
+		"""Stop the receiver and clean up"""
+		assert not self.want_stop
+
+		self.want_stop = True
+
+		if self.diagnostics is not None:
+			self.diagnostics.stop()
+
+		self.thread.join()
+
+		self._stop_receiver()
+
+	def get(self, id=None):
+		"""Get the last received state
+
+		Returns data from the last received packet as a
+		EnergyCount3KState object. If id is given, returns the last
+		state received from that device.
+		"""
+		if id is None:
+			return self.state
+		else:
+			return self.states.get(id)
+
+	def downtime(self):
+		"""Return total time in seconds without packets due to recorded restarts
+
+		Restarts that happen before the receiver recovers from an
+		earlier one are counted only once.
+		"""
+		now = time.time()
+
+		total = 0.0
+		end = None
+		for reason, failed, recovered in self.restarts:
+			if recovered is None:
+				recovered = now
+			if end is not None:
+				failed = max(failed, end)
+			if recovered > failed:
+				total += recovered - failed
+				end = recovered
+
+		return total
+
+	def _log(self, msg):
+		"""Override this method to capture debug information"""
+		pass
+
+	def _start_receiver(self):
+		self.conn, child_conn = multiprocessing.Pipe()
+
+		kwargs = dict(self.kwargs)
+		if (self.scheduler is not None) and self.scheduler.gate:
+			# the receiver needs schedules learned so far for gating.
+			kwargs['scheduler'] = self.scheduler
+
+		self.tempdir = tempfile.mkdtemp()
+
+		if self.diagnostics is not None:
+			diagnostics_interval = self.diagnostics.interval
+		else:
+			diagnostics_interval = None
+
+		self.process = multiprocessing.Process(target=_supervised_receiver,
+				args=(child_conn, self.receiver_class, kwargs, 1.0, self.tempdir,
+					diagnostics_interval))
+		self.process.daemon = True
+		self.process.start()
+
+		child_conn.close()
+
+		now = time.time()
+		self.last_packet = now
+		self.last_noise = now
+
+	def _stop_receiver(self):
+		if self.process is None:
+			return
+
+		try:
+			self.conn.send('stop')
+		except (IOError, EOFError):
+			pass
+
+		self.process.join(self.stop_timeout)
+		if self.process.is_alive():
+			self._log("Receiver process did not stop, killing it")
+			try:
+				os.killpg(self.process.pid, signal.SIGKILL)
+			except OSError:
+				# process group not set up yet
+				os.kill(self.process.pid, signal.SIGKILL)
+			self.process.join()
+
+		self.conn.close()
+		self.process = None
+
+		shutil.rmtree(self.tempdir, ignore_errors=True)
+		self.tempdir = None
+
+	def _restart_receiver(self, reason):
+		self._log("Restarting receiver: %s" % (reason,))
+		self.restarts.append((reason, time.time(), None))
+
+		self.noise_level = -90
+		self._stop_receiver()
+
+		deadline = time.time() + self.backoff
+		self.backoff = min(max(self.backoff * 2, self.backoff_min), self.backoff_max)
+
+		while time.time() < deadline:
+			if self.want_stop:
+				return
+			time.sleep(max(0, min(0.1, deadline - time.time())))
+
+		self._start_receiver()
+
+	def _on_state(self, state):
+		now = time.time()
+		self.last_packet = now
+
+		for n, (reason, failed, recovered) in enumerate(self.restarts):
+			if recovered is None:
+				self.restarts[n] = (reason, failed, now)
+
+		self.backoff = 0
+
+		if (state.id not in self.states) and (len(self.states) >= self.max_devices):
+			oldest = min(self.states.itervalues(), key=lambda s: s.timestamp)
+			del self.states[oldest.id]
+
+		self.state = state
+		self.states[state.id] = state
+		if self.scheduler is not None:
+			self.scheduler.update(state)
+		if self.callback:
+			self.callback(state)
+
+	def _on_noise(self, noise_level):
+		self.noise_level = noise_level
+		if noise_level > -90:
+			self.last_noise = time.time()
+
+	def _on_diagnostics(self, report):
+		if self.diagnostics.callback:
+			self.diagnostics.callback(report)
+
+	def _check(self):
+		now = time.time()
+
+		if not self.process.is_alive():
+			return "receiver process died"
+
+		if now - self.last_noise > self.stall_timeout:
+			return "noise level stuck at %.1f dB" % (self.noise_level,)
+
+		if (self.packet_timeout is not None) and (now - self.last_packet > self.packet_timeout):
+			return "no packets received"
+
+		return None
+
+	def _supervisor_thread(self):
+		while not self.want_stop:
+			try:
+				if self.conn.poll(1.0):
+					kind, value = self.conn.recv()
+					if kind == 'state':
+						self._on_state(value)
+					elif kind == 'noise':
+						self._on_noise(value)
+					elif kind == 'diagnostics':
+						self._on_diagnostics(value)
+			except (IOError, EOFError):
+				# receiver process died; detected below
+				time.sleep(0.1)
+
+			reason = self._check()
+			if reason is not None:
+				self._restart_receiver(reason)
+
+class Sink:
+	"""Base class for network sinks for decoded states
+
+	States passed to put() are buffered and sent in batches over a
+	persistent connection. A batch is sent when it contains batch_size
+	states or, from a timer thread, when the oldest state in it is
+	batch_interval seconds old.
+
+	Connecting and sending time out after timeout seconds.
+
+	Sent states contain EnergyCount3KState.FIELDS and the reception
+	timestamp.
+
+	If the connection fails, the sink reconnects with an exponential
+	backoff. States that can't be sent in the meantime are appended to
+	spill_path (if given) and sent after the connection is restored.
+	Otherwise they are dropped. At most max_spill states are kept in
+	spill_path.
+	"""
+
+	FIELDS = EnergyCount3KState.FIELDS + [ 'timestamp' ]
+
+	def __init__(self, batch_size=1, batch_interval=None, spill_path=None,
+			backoff_min=1.0, backoff_max=60.0, max_spill=100000, timeout=10.0):
+		self.batch_size = batch_size
+		self.batch_interval = batch_interval
+		self.timeout = timeout
+		self.spill_path = spill_path
+		self.backoff_min = backoff_min
+		self.backoff_max = backoff_max
+		self.max_spill = max_spill
+
+		self.spilled = 0
+		if (spill_path is not None) and os.path.exists(spill_path):
+			self.spilled = sum(1 for line in open(spill_path))
+
+		self.batch = []
+		self.timer = None
+		self.lock = threading.RLock()
+
+		self.connected = False
+		self.backoff = backoff_min
+		self.retry_time = 0
+
+	def put(self, state):
+		"""Queue a EnergyCount3KState object for sending"""
+		with self.lock:
+			self.batch.append(state.to_dict(self.FIELDS))
+
+			if len(self.batch) >= self.batch_size:
+				self.flush()
+			elif (self.timer is None) and (self.batch_interval is not None):
+				self.timer = threading.Timer(self.batch_interval, self.flush)
+				self.timer.daemon = True
+				self.timer.start()
+
+	def flush(self):
+		"""Send all queued states"""
+		with self.lock:
+			if self.timer is not None:
+				self.timer.cancel()
+				self.timer = None
+
+			batch = self.batch
+			self.batch = []
+
+			if not batch:
+				return
+
+			if self._ensure_connected():
+				try:
+					self._send_spill()
+					self._send(batch)
+					return
+				except (socket.error, IOError), e:
+					self._log("Send failed: %s" % (e,))
+					self._fail()
+
+			try:
+				self._spill(batch)
+			except (IOError, OSError), e:
+				self._log("Spill failed, dropped %d states: %s" % (len(batch), e))
+
+	def close(self):
+		"""Send all queued states and close the connection"""
+		with self.lock:
+			self.flush()
+			if self.connected:
+				self._disconnect()
+				self.connected = False
+
+	def _log(self, msg):
+		"""Override this method to capture debug information"""
+		pass
+
+	def _ensure_connected(self):
+		if self.connected:
+			return True
+
+		if time.time() < self.retry_time:
+			return False
+
+		try:
+			self._connect()
+		except (socket.error, IOError), e:
+			self._log("Connect failed: %s" % (e,))
+			self._fail()
+			return False
+
+		self.connected = True
+		self.backoff = self.backoff_min
+		return True
+
+	def _fail(self):
+		if self.connected:
+			try:
+				self._disconnect()
+			except (socket.error, IOError):
+				pass
+			self.connected = False
+
+		self.retry_time = time.time() + self.backoff
+		self.backoff = min(self.backoff * 2, self.backoff_max)
+
+	def _spill(self, batch):
+		if self.spill_path is not None:
+			n = max(0, min(len(batch), self.max_spill - self.spilled))
+		else:
+			n = 0
+
+		if n < len(batch):
+			self._log("Dropped %d states" % (len(batch) - n,))
+
+		if n == 0:
+			return
+
+		f = open(self.spill_path, "a")
+		try:
+			for fields in batch[:n]:
+				f.write(json.dumps(fields) + "\n")
+		finally:
+			f.close()
+
+		self.spilled += n
+
+	def _send_spill(self):
+		if (self.spill_path is None) or (not os.path.exists(self.spill_path)):
+			return
+
+		f = open(self.spill_path)
+		try:
+			while True:
+				batch = [ json.loads(line) for line in itertools.islice(f, self.batch_size) ]
+				if not batch:
+					break
+				self._send(batch)
+		finally:
+			f.close()
+
+		os.unlink(self.spill_path)
+		self.spilled = 0
+
+	def _connect(self):
+		raise NotImplementedError
+
+	def _disconnect(self):
+		raise NotImplementedError
+
+	def _send(self, batch):
+		raise NotImplementedError
+
+class TCPSink(Sink):
+	"""Sink sending one JSON object per line over a TCP connection"""
+	def __init__(self, host, port, **kwargs):
+		Sink.__init__(self, **kwargs)
+		self.host = host
+		self.port = port
+
+	def _connect(self):
+		self.sock = socket.create_connection((self.host, self.port), self.timeout)
+
+	def _disconnect(self):
+		self.sock.close()
+
+	def _send(self, batch):
+		self.sock.sendall("".join(json.dumps(fields) + "\n" for fields in batch))
+
+class UDPSink(Sink):
+	"""Sink sending JSON lines in UDP datagrams
+
+	Lines are packed into as few datagrams as possible, each at most
+	max_size bytes long.
+	"""
+	def __init__(self, host, port, max_size=1400, **kwargs):
+		Sink.__init__(self, **kwargs)
+		self.host = host
+		self.port = port
+		self.max_size = max_size
+
+	def _connect(self):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.settimeout(self.timeout)
+		self.sock.connect((self.host, self.port))
+
+	def _disconnect(self):
+		self.sock.close()
+
+	def _send(self, batch):
+		datagram = ""
+		for fields in batch:
+			line = json.dumps(fields) + "\n"
+			if datagram and (len(datagram) + len(line) > self.max_size):
+				self.sock.send(datagram)
+				datagram = ""
+			datagram += line
+
+		if datagram:
+			self.sock.send(datagram)
+
+class MQTTSink(Sink):
+	"""Sink publishing states to a MQTT broker
+
+	Each state is published as a JSON object to topic "<topic>/<id>",
+	where id is the device ID in hex. Only the subset of MQTT 3.1.1
+	needed for QoS 0 publishing is implemented.
+	"""
+	def __init__(self, host, port=1883, topic="ec3k", client_id="ec3k", **kwargs):
+		Sink.__init__(self, **kwargs)
+		self.host = host
+		self.port = port
+		self.topic = topic
+		self.client_id = client_id
+
+	def _encode_string(self, s):
+		return struct.pack("!H", len(s)) + s
+
+	def _encode_packet(self, header, body):
+		length = len(body)
+		encoded_length = ""
+		while True:
+			digit = length % 0x80
+			length /= 0x80
+			if length > 0:
+				digit |= 0x80
+			encoded_length += chr(digit)
+			if length == 0:
+				break
+
+		return chr(header) + encoded_length + body
+
+	def _connect(self):
+		self.sock = socket.create_connection((self.host, self.port), self.timeout)
+
+		# protocol name, level 4 (3.1.1), clean session, keep alive disabled
+		body = self._encode_string("MQTT") + struct.pack("!BBH", 4, 0x02, 0)
+		body += self._encode_string(self.client_id)
+
+		try:
+			self.sock.sendall(self._encode_packet(0x10, body))
+
+			connack = ""
+			while len(connack) < 4:
+				data = self.sock.recv(4 - len(connack))
+				if not data:
+					raise IOError("Connection closed by broker")
+				connack += data
+
+			if (ord(connack[0]) != 0x20) or (ord(connack[3]) != 0):
+				raise IOError("Connection refused by broker: %r" % (connack,))
+		except:
+			self.sock.close()
+			raise
+
+	def _disconnect(self):
+		self.sock.close()
+
+	def _send(self, batch):
+		packets = []
+		for fields in batch:
+			topic = "%s/%04x" % (self.topic, fields['id'])
+			body = self._encode_string(topic) + json.dumps(fields)
+			packets.append(self._encode_packet(0x30, body))
+
+		self.sock.sendall("".join(packets))
+
+class Diagnostics:
+	"""Periodic memory use report for a long running receiver
+
+	Every interval seconds, callback is called with a dictionary
+	containing the process ID, garbage collector statistics and, for
+	each pipeline stage in STAGES, the number of live objects belonging
+	to it and its rate of change per second. If the tracemalloc module
+	is available (Python 3), it also contains the rate of growth of
+	memory allocated by code in each stage, in bytes and blocks per
+	second.
+
+	Values passed to update() are included in the next report. The
+	receiver uses this to report statistics of the capture process as
+	the 'capture' stage.
+	"""
+
+	STAGES = [
+		('decode',	[ EnergyCount3KState, DecodePlan, decode_burst ]),
+		('schedule',	[ TransmissionScheduler, DeviceSchedule ]),
+		('receiver',	[ EnergyCount3K, EnergyCount3KSupervisor, RunLengthEncoderBlock ]),
+		('sink',	[ Sink, TCPSink, UDPSink, MQTTSink ]),
+	]
+
+	def __init__(self, interval=60.0, callback=None):
+		self.interval = interval
+		self.callback = callback
+
+		self.classes = []
+		self.ranges = []
+		for stage, objs in self.STAGES:
+			for obj in objs:
+				if inspect.isclass(obj):
+					self.classes.append((stage, obj))
+
+				lines, start = inspect.getsourcelines(obj)
+				path = os.path.abspath(inspect.getsourcefile(obj))
+				self.ranges.append((path, start, start + len(lines), stage))
+
+		self.want_stop = True
+		self.snapshot = None
+
+		self.stats = {}
+		self.last_objects = None
+
+	def start(self):
+		"""Start periodic reports"""
+		assert self.want_stop
+
+		self.want_stop = False
+
+		if tracemalloc is not None:
+			if not tracemalloc.is_tracing():
+				tracemalloc.start()
+			self._take_snapshot()
+
+		self.thread = threading.Thread(target=self._report_thread)
+		self.thread.start()
+
+	def stop(self):
+		"""Stop periodic reports"""
+		assert not self.want_stop
+
+		self.want_stop = True
+		self.thread.join()
+
+	def update(self, stage, values):
+		"""Include a dictionary of values in reports for stage"""
+		self.stats[stage] = values
+
+	def report(self):
+		"""Return current memory use report"""
+		now = time.time()
+
+		stages = dict((stage, {'objects': 0}) for stage, objs in self.STAGES)
+
+		objects = gc.get_objects()
+		for obj in objects:
+			for stage, cls in self.classes:
+				if isinstance(obj, cls):
+					stages[stage]['objects'] += 1
+					break
+
+		# the list references this frame, which references the list.
+		# Break the cycle so that the objects are not kept alive until
+		# the next collection.
+		num_objects = len(objects)
+		del objects, obj
+
+		if self.last_objects is not None:
+			last_time, last_objects = self.last_objects
+			elapsed = max(1e-9, now - last_time)
+			for stage, values in stages.iteritems():
+				values['growth_objects'] = (values['objects'] - last_objects[stage]) / elapsed
+
+		self.last_objects = (now, dict((stage, values['objects'])
+				for stage, values in stages.iteritems()))
+
+		if self.snapshot is not None:
+			for stage, size, count in self._growth():
+				stages.setdefault(stage, {'objects': 0})
+				stages[stage]['growth_bytes'] = size
+				stages[stage]['growth_blocks'] = count
+
+		for stage, values in self.stats.items():
+			stages.setdefault(stage, {}).update(values)
+
+		return {
+			'time': now,
+			'pid': os.getpid(),
+			'gc': {
+				'counts': gc.get_count(),
+				'objects': num_objects,
+				'garbage': len(gc.garbage),
+			},
+			'stages': stages,
+		}
+
+	def _stage(self, path, lineno):
+		for range_path, start, end, stage in self.ranges:
+			if (path == range_path) and (start <= lineno < end):
+				return stage
+
+		return 'other'
+
+	def _take_snapshot(self):
+		self.snapshot = tracemalloc.take_snapshot()
+		self.snapshot_time = time.time()
+
+	def _growth(self):
+		snapshot = self.snapshot
+		snapshot_time = self.snapshot_time
+
+		self._take_snapshot()
+		elapsed = max(1e-9, self.snapshot_time - snapshot_time)
+
+		growth = {}
+		for stat in self.snapshot.compare_to(snapshot, 'lineno'):
+			frame = stat.traceback[0]
+			stage = self._stage(os.path.abspath(frame.filename), frame.lineno)
+
+			size, count = growth.get(stage, (0, 0))
+			growth[stage] = (size + stat.size_diff, count + stat.count_diff)
+
+		return [ (name, total_size / elapsed, total_count / elapsed)
+				for name, (total_size, total_count) in growth.iteritems() ]
+
+	def _report_thread(self):
+		next_report = time.time() + self.interval
+
+		while not self.want_stop:
+			if time.time() < next_report:
+				time.sleep(min(1.0, self.interval))
+				continue
+
+			next_report += self.interval
+
+			report = self.report()
+			if self.callback:
+				self.callback(report)
@@ -1,14 +1,46 @@
+import capture
 import ec3k
+import imp
+import itertools
+import multiprocessing
 import os
+import StringIO
+import shutil
+import socket
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 import json
+import numpy
+
+# packet from device f100 (energy 138854 Ws)
+HEX_BYTES = ['ca', 'ff', '9c', 'e0', '66', '10', '34', '6d', '3a', '83', '53', '12', 'fe', 'c0', 'f5', '09', '4c', '76', '07', '3d', '16', '29', '96', '8f', '75', '1d', '93', '7e', '54', 'cf', '1e', 'c2', '36', '17', '2f', '2c', '0e', '12', 'cd', '8f', '14', '8e', '77', '1e', 'f1', 'ca', 'ce', 'e3', '23', 'e9', '05', 'ce', '74', 'aa', 'da', '52', '62', 'a5', 'b1', 'a3', '58', '4e', 'bd', 'ae', 'c4', '77', 'e9', '89', 'a0']
+
+def read_lines(count=None):
+	"""Return the first count lines of tests.json (all if count is None)"""
+	path = os.path.join(os.path.dirname(__file__), "tests.json")
+	with open(path) as f:
+		return list(itertools.islice(f, count))
+
+def read_packets(count=None):
+	"""Return hex bytes of the first count packets in tests.json"""
+	return [ json.loads(line) for line in read_lines(count) ]
+
+def samples(hex_bytes):
+	"""Expand hex bytes into capture input, 8 samples per bit"""
+	data = ''
+	for hex_byte in hex_bytes:
+		i = int(hex_byte, 16)
+		for n in xrange(8):
+			data += ('\xff' if (i<<n) & 0x80 else '\x00') * 8
+	return data
 
 class TestEnergyCount3KState(unittest.TestCase):
 	def test_basic(self):
-		hex_bytes = ['ca', 'ff', '9c', 'e0', '66', '10', '34', '6d', '3a', '83', '53', '12', 'fe', 'c0', 'f5', '09', '4c', '76', '07', '3d', '16', '29', '96', '8f', '75', '1d', '93', '7e', '54', 'cf', '1e', 'c2', '36', '17', '2f', '2c', '0e', '12', 'cd', '8f', '14', '8e', '77', '1e', 'f1', 'ca', 'ce', 'e3', '23', 'e9', '05', 'ce', '74', 'aa', 'da', '52', '62', 'a5', 'b1', 'a3', '58', '4e', 'bd', 'ae', 'c4', '77', 'e9', '89', 'a0']
-
-		state = ec3k.EnergyCount3KState(hex_bytes)
+		state = ec3k.EnergyCount3KState(HEX_BYTES)
 
 		self.assertEqual(state.id, 0xf100)
 		self.assertEqual(state.time_total, 36725)
@@ -29,6 +61,11 @@ class TestEnergyCount3KState(unittest.TestCase):
 		self.assertEqual(state.current_power, state.power_current)
 		self.assertEqual(state.max_power, state.power_max)
 
+	def test_timestamp(self):
+		state = ec3k.EnergyCount3KState(HEX_BYTES, timestamp=1000.0)
+		self.assertEqual(state.timestamp, 1000.0)
+		self.assertFalse('timestamp' in state.to_dict())
+
 	def test_decode_log(self):
 		count = count_invalid = 0
 
@@ -63,3 +100,714 @@ class TestEnergyCount3KState(unittest.TestCase):
 
 		self.assertEqual(count, 6151)
 		self.assertEqual(count_invalid, 173)
+
+	def test_sample_timestamp(self):
+		receiver = ec3k.EnergyCount3K(clock_tolerance=1.0)
+		receiver.stream_start = 1000.0
+
+		self.assertEqual(receiver._sample_timestamp(0, 1000.2), 1000.0)
+		self.assertEqual(receiver._sample_timestamp(48000, 1000.6), 1000.5)
+
+		# samples were dropped: re-anchor to the time of reading
+		self.assertEqual(receiver._sample_timestamp(96000, 1005.0), 1005.0)
+		self.assertEqual(receiver._sample_timestamp(192000, 1006.1), 1006.0)
+
+		# never later than the time of reading
+		self.assertEqual(receiver._sample_timestamp(288000, 1006.5), 1006.5)
+
+	def test_sample_timestamp_first(self):
+		receiver = ec3k.EnergyCount3K()
+		receiver.stream_start = None
+
+		self.assertEqual(receiver._sample_timestamp(96000, 1001.0), 1001.0)
+		self.assertEqual(receiver.stream_start, 1000.0)
+
+class TestPacketizer(unittest.TestCase):
+	def test_start(self):
+		packetizer = capture.Packetizer()
+
+		data = '\x00' * 50 + ('\xff' * 4 + '\x00' * 4) * 10 + '\x00' * 200
+
+		# split input between two feed() calls
+		packets = list(packetizer.feed(data[:30]))
+		packets += list(packetizer.feed(data[30:]))
+
+		self.assertEqual(len(packets), 1)
+		self.assertEqual(packets[0].start, 50)
+
+	def test_max_length(self):
+		packetizer = capture.Packetizer(max_length=100)
+
+		data = ('\xff\xff\x00\x00' * 100) + '\x00' * 200
+
+		self.assertEqual(list(packetizer.feed(data)), [])
+
+		stats = dict(packetizer.stats())
+		self.assertEqual(stats['packets'], 0)
+		self.assertTrue(stats['dropped'] > 0)
+
+	def test_stats(self):
+		data = '\x00' * 50 + ('\xff' * 4 + '\x00' * 4) * 10 + '\x00' * 200
+
+		stdout = sys.stdout
+		sys.stdout = StringIO.StringIO()
+		try:
+			capture.run_loop(StringIO.StringIO(data), stats_interval=0)
+			output = sys.stdout.getvalue()
+		finally:
+			sys.stdout = stdout
+
+		lines = [ line for line in output.split('\n') if line.startswith('stats ') ]
+		self.assertEqual(lines, [ 'stats packets 1 dropped 0 longest 76 buffered 0' ])
+
+	def test_collision(self):
+		hex_bytes_1, hex_bytes_2 = read_packets(2)
+
+		# two packets separated by a glitch
+		data = '\x00' * 200 + samples(hex_bytes_1) + '\xff\x00' + samples(hex_bytes_2) + '\x00' * 200
+
+		stdout = sys.stdout
+		sys.stdout = StringIO.StringIO()
+		try:
+			for packet in capture.Packetizer().feed(data):
+				packet.recover_clock()
+			output = sys.stdout.getvalue()
+		finally:
+			sys.stdout = stdout
+
+		states = []
+		for line in output.split('\n'):
+			fields = line.split()
+			if fields and (fields[0] == 'data'):
+				states += ec3k.decode_burst(fields[1:])
+
+		self.assertEqual([ state.time_total for state in states ], [ 7822, 7827 ])
+
+class TestRunLength(unittest.TestCase):
+	def setUp(self):
+		data = ''
+		for hex_bytes in read_packets(5):
+			data += '\x00' * 1000 + samples(hex_bytes)
+		data += '\x00' * 1000
+
+		self.data = data
+
+	def _packets(self, packetizer, data):
+		return [ (packet.start, packet.data) for packet in packetizer.feed(data) ]
+
+	def test_packetizer(self):
+		encoder = capture.RunLengthEncoder()
+		encoded = encoder.feed(self.data) + encoder.flush()
+
+		self.assertTrue(len(encoded) < len(self.data))
+		self.assertEqual(len(encoder.index), 5)
+
+		packets = self._packets(capture.Packetizer(), self.data)
+		self.assertEqual(len(packets), 5)
+
+		# feed in small chunks to split records
+		run_packetizer = capture.RunPacketizer()
+		run_packets = []
+		for n in xrange(0, len(encoded), 7):
+			run_packets += self._packets(run_packetizer, encoded[n:n+7])
+
+		self.assertEqual(run_packets, packets)
+
+		# seek to the fourth packet
+		fd = StringIO.StringIO(encoded)
+		run_packetizer = capture.RunPacketizer()
+		run_packetizer.seek(fd, encoder.index, encoder.index[3][0] + 10)
+
+		self.assertEqual(self._packets(run_packetizer, fd.read()), packets[3:])
+
+	def test_encode_runs(self):
+		samples = numpy.array([ ord(c) >> 7 for c in self.data ], dtype=numpy.uint8)
+
+		encoded = ''
+		value = length = 0
+		for n in xrange(0, len(samples), 1024):
+			records, value, length = ec3k.encode_runs(samples[n:n+1024], value, length, 500)
+			encoded += records.astype('<u4').tostring()
+
+		packets = self._packets(capture.Packetizer(), self.data)
+		run_packets = self._packets(capture.RunPacketizer(), encoded)
+
+		self.assertEqual(run_packets, packets)
+
+class TestDecodeBurst(unittest.TestCase):
+	def test_back_to_back(self):
+		hex_bytes_1, hex_bytes_2 = read_packets(2)
+
+		self.assertRaises(ec3k.InvalidPacket, ec3k.EnergyCount3KState, hex_bytes_1 + hex_bytes_2)
+
+		states = ec3k.decode_burst(hex_bytes_1 + hex_bytes_2)
+		self.assertEqual([ state.time_total for state in states ], [ 7822, 7827 ])
+
+	def test_no_frames(self):
+		self.assertRaises(ec3k.InvalidPacket, ec3k.decode_burst, ['00'] * 10)
+
+def load_ec3k_recv():
+	path = os.path.join(os.path.dirname(__file__), "ec3k_recv")
+
+	# don't leave ec3k_recvc next to the script
+	dont_write_bytecode = sys.dont_write_bytecode
+	sys.dont_write_bytecode = True
+	try:
+		return imp.load_source('ec3k_recv', path)
+	finally:
+		sys.dont_write_bytecode = dont_write_bytecode
+
+class TestDecodeCommand(unittest.TestCase):
+	def setUp(self):
+		self.ec3k_recv = load_ec3k_recv()
+
+		self.line_1, self.line_2 = read_lines(2)
+
+	def test_json_line(self):
+		hex_bytes = json.loads(self.line_1)
+		self.assertEqual(self.ec3k_recv.parse_line(self.line_1), hex_bytes)
+
+		valid, packets = self.ec3k_recv.decode_line((self.line_1, None))
+		self.assertTrue(valid)
+		self.assertEqual(len(packets), 1)
+		self.assertEqual(packets[0]['id'], 0x28f8)
+		self.assertEqual(packets[0]['time_total'], 7822)
+		self.assertEqual(packets[0]['timestamp'], None)
+
+	def test_data_line(self):
+		hex_bytes = json.loads(self.line_1)
+		line = "data " + " ".join(hex_bytes) + "\n"
+		self.assertEqual(self.ec3k_recv.parse_line(line), hex_bytes)
+
+		valid, packets = self.ec3k_recv.decode_line((line, None))
+		self.assertTrue(valid)
+		self.assertEqual([ p['time_total'] for p in packets ], [ 7822 ])
+
+		self.assertEqual(self.ec3k_recv.parse_line("0101110\n"), None)
+		self.assertEqual(self.ec3k_recv.decode_line(("0101110\n", None)), (True, []))
+
+	def test_start_line(self):
+		lines = [ "start 96000\n", "data " + " ".join(json.loads(self.line_1)) + "\n" ]
+
+		items = list(self.ec3k_recv.read_lines(lines, 1000.0, 96000))
+		self.assertEqual(len(items), 1)
+
+		valid, packets = self.ec3k_recv.decode_line(items[0])
+		self.assertEqual(packets[0]['timestamp'], 1001.0)
+
+	def test_malformed(self):
+		self.assertEqual(self.ec3k_recv.decode_line(('["ca", "ff", \n', None)), (False, []))
+		self.assertEqual(self.ec3k_recv.decode_line(('["00", "00"]\n', None)), (False, []))
+		self.assertEqual(self.ec3k_recv.decode_line(("data zz\n", None)), (False, []))
+
+	def test_multiple_frames(self):
+		line = json.dumps(json.loads(self.line_1) + json.loads(self.line_2))
+
+		valid, packets = self.ec3k_recv.decode_line((line, None))
+		self.assertTrue(valid)
+		self.assertEqual([ p['time_total'] for p in packets ], [ 7822, 7827 ])
+
+	def test_imap_bounded(self):
+		consumed = []
+		def items():
+			for n in xrange(-1000, 0):
+				consumed.append(n)
+				yield n
+
+		pool = multiprocessing.Pool(2)
+		try:
+			results = self.ec3k_recv.imap_bounded(pool, abs, items(), 4, 16)
+
+			self.assertEqual(results.next(), 1000)
+			self.assertTrue(len(consumed) <= 32)
+
+			self.assertEqual(list(results), range(999, 0, -1))
+		finally:
+			pool.close()
+			pool.join()
+
+	def test_format(self):
+		valid, packets = self.ec3k_recv.decode_line((self.line_1, None))
+
+		columns = [ 'id', 'energy', 'timestamp' ]
+		self.assertEqual(self.ec3k_recv.format_csv(packets[0], columns), "10488,%d," % (packets[0]['energy'],))
+		self.assertEqual(json.loads(self.ec3k_recv.format_json(packets[0]))['id'], 0x28f8)
+
+class TestTransmissionScheduler(unittest.TestCase):
+	def test_schedule(self):
+		scheduler = ec3k.TransmissionScheduler()
+
+		for hex_bytes in read_packets():
+			try:
+				state = ec3k.EnergyCount3KState(hex_bytes)
+			except ec3k.InvalidPacket:
+				continue
+
+			# use device time as the reception time
+			state.timestamp = state.time_total + 1000.0
+			scheduler.update(state)
+
+		self.assertEqual(scheduler.devices.keys(), [ 0x28f8 ])
+
+		device = scheduler.devices[0x28f8]
+		self.assertAlmostEqual(device.period, 5.0)
+		self.assertEqual(device.received, 5978)
+		self.assertEqual(device.missed, 636)
+
+		t = scheduler.predict(0x28f8)
+		self.assertEqual(scheduler.expected(t), [ 0x28f8 ])
+		self.assertEqual(scheduler.expected(t + 10.0), [ 0x28f8 ])
+		self.assertEqual(scheduler.expected(t + 2.5), [])
+
+		# silent after max_missed transmissions
+		self.assertEqual(scheduler.expected(t + 15.0), [])
+
+		self.assertEqual(scheduler.overdue(t), [])
+		self.assertEqual(scheduler.overdue(t + 2.5), [ 0x28f8 ])
+		self.assertEqual(scheduler.overdue(t + 15.0), [ 0x28f8 ])
+
+	def test_max_devices(self):
+		scheduler = ec3k.TransmissionScheduler(max_devices=2)
+
+		state = ec3k.EnergyCount3KState(read_packets(1)[0])
+
+		for id in xrange(3):
+			state.id = id
+			state.timestamp = 1000.0 + id
+			scheduler.update(state)
+
+		self.assertEqual(sorted(scheduler.devices.keys()), [ 1, 2 ])
+
+class StalledReceiver:
+	"""Receiver that reports one packet and then stalls"""
+	def __init__(self, callback, hex_bytes, diagnostics=None):
+		self.callback = callback
+		self.hex_bytes = hex_bytes
+		self.diagnostics = diagnostics
+		self.noise_level = -90
+
+	def start(self):
+		if self.diagnostics is not None:
+			self.diagnostics.start()
+		self.callback(ec3k.EnergyCount3KState(self.hex_bytes))
+
+	def stop(self):
+		if self.diagnostics is not None:
+			self.diagnostics.stop()
+
+class FailingReceiver:
+	"""Receiver that fails to start"""
+	def __init__(self, callback):
+		self.noise_level = -90
+
+	def start(self):
+		raise Exception("no device")
+
+class NoDeviceReceiver(ec3k.EnergyCount3K):
+	"""Receiver that starts the capture process and fails to open the radio"""
+	def __init__(self, callback, log_path):
+		ec3k.EnergyCount3K.__init__(self, callback=callback)
+		self.log_path = log_path
+
+	def _setup_top_block(self):
+		with open(self.log_path, 'a') as f:
+			f.write("%d %s\n" % (self.capture_process.pid, self.tempdir))
+
+		raise Exception("no device")
+
+class HangingReceiver:
+	"""Receiver with a child process that doesn't stop"""
+	def __init__(self, callback, log_path):
+		self.log_path = log_path
+		self.noise_level = -50
+
+	def start(self):
+		self.process = subprocess.Popen(["sleep", "60"])
+		with open(self.log_path, 'a') as f:
+			f.write("%d %s\n" % (self.process.pid, tempfile.gettempdir()))
+
+	def stop(self):
+		time.sleep(60)
+
+def process_running(pid):
+	try:
+		stat = open("/proc/%d/stat" % (pid,)).read()
+	except IOError:
+		return False
+
+	# zombies are waiting for their reparented parent to reap them
+	return stat.split()[2] != 'Z'
+
+class TestEnergyCount3KSupervisor(unittest.TestCase):
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp()
+		self.log_path = os.path.join(self.tempdir, "log")
+
+		# capture program that waits for a pipe that is never written
+		path = os.path.join(self.tempdir, "capture")
+		with open(path, 'w') as f:
+			f.write("#!/bin/sh\nexec sleep 60\n")
+		os.chmod(path, 0755)
+
+		self.path = os.environ["PATH"]
+		os.environ["PATH"] = self.tempdir + os.pathsep + self.path
+
+	def tearDown(self):
+		os.environ["PATH"] = self.path
+		shutil.rmtree(self.tempdir)
+
+	def read_log(self):
+		entries = []
+		for line in open(self.log_path):
+			pid, path = line.split()
+			entries.append((int(pid), path))
+		return entries
+
+	def test_restart(self):
+		states = []
+
+		supervisor = ec3k.EnergyCount3KSupervisor(
+				callback=states.append,
+				stall_timeout=0.5,
+				receiver_class=StalledReceiver,
+				hex_bytes=HEX_BYTES)
+
+		supervisor.start()
+		time.sleep(4)
+		supervisor.stop()
+
+		self.assertTrue(len(supervisor.restarts) >= 1)
+		self.assertEqual(supervisor.restarts[0][0], "noise level stuck at -90.0 dB")
+		self.assertTrue(supervisor.restarts[0][2] is not None)
+
+		self.assertTrue(len(states) >= len(supervisor.restarts))
+		self.assertEqual(supervisor.get(0xf100).energy, 138854)
+		self.assertTrue(supervisor.downtime() >= 0)
+
+	def test_restart_no_device(self):
+		supervisor = ec3k.EnergyCount3KSupervisor(
+				receiver_class=NoDeviceReceiver,
+				backoff_min=0.5,
+				log_path=self.log_path)
+
+		supervisor.start()
+		time.sleep(2)
+		supervisor.stop()
+
+		entries = self.read_log()
+		self.assertTrue(len(entries) >= 2)
+
+		for pid, path in entries:
+			self.assertFalse(process_running(pid))
+			self.assertFalse(os.path.exists(path))
+
+	def test_kill(self):
+		supervisor = ec3k.EnergyCount3KSupervisor(
+				receiver_class=HangingReceiver,
+				stop_timeout=0.5,
+				log_path=self.log_path)
+
+		supervisor.start()
+		time.sleep(1)
+		supervisor.stop()
+
+		entries = self.read_log()
+		self.assertEqual(len(entries), 1)
+
+		pid, path = entries[0]
+		time.sleep(0.1)
+		self.assertFalse(process_running(pid))
+		self.assertFalse(os.path.exists(path))
+
+	def test_restart_backoff(self):
+		supervisor = ec3k.EnergyCount3KSupervisor(
+				receiver_class=FailingReceiver,
+				backoff_min=1.0)
+
+		start = time.time()
+		supervisor.start()
+		time.sleep(3.5)
+		supervisor.stop()
+		elapsed = time.time() - start
+
+		# immediate restart, then after 1 and 2 seconds
+		self.assertTrue(len(supervisor.restarts) <= 4)
+		self.assertEqual(supervisor.restarts[0][0], "receiver process died")
+
+		# restarts overlap and are never recovered
+		self.assertTrue(supervisor.downtime() <= elapsed)
+
+	def test_scheduler(self):
+		hex_bytes = read_packets(1)[0]
+
+		scheduler = ec3k.TransmissionScheduler()
+
+		supervisor = ec3k.EnergyCount3KSupervisor(
+				stall_timeout=0.5,
+				scheduler=scheduler,
+				receiver_class=StalledReceiver,
+				hex_bytes=hex_bytes)
+
+		supervisor.start()
+		time.sleep(2)
+		supervisor.stop()
+
+		# packets from all receiver processes are counted in this process
+		self.assertTrue(len(supervisor.restarts) >= 1)
+		self.assertEqual(scheduler.devices.keys(), [ 0x28f8 ])
+		self.assertTrue(scheduler.devices[0x28f8].received > 1)
+
+	def test_max_devices(self):
+		supervisor = ec3k.EnergyCount3KSupervisor(max_devices=2)
+
+		hex_bytes = read_packets(1)[0]
+
+		for id in xrange(3):
+			state = ec3k.EnergyCount3KState(hex_bytes, 1000.0 + id)
+			state.id = id
+			supervisor._on_state(state)
+
+		self.assertEqual(sorted(supervisor.states.keys()), [ 1, 2 ])
+		self.assertEqual(supervisor.get().id, 2)
+
+	def test_diagnostics(self):
+		hex_bytes = read_packets(1)[0]
+
+		reports = []
+		diagnostics = ec3k.Diagnostics(interval=0.1, callback=reports.append)
+
+		supervisor = ec3k.EnergyCount3KSupervisor(
+				receiver_class=StalledReceiver,
+				diagnostics=diagnostics,
+				hex_bytes=hex_bytes)
+
+		supervisor.start()
+		time.sleep(1)
+		supervisor.stop()
+
+		# reports from this process and forwarded from the receiver
+		pids = set(report['pid'] for report in reports)
+		self.assertTrue(os.getpid() in pids)
+		self.assertEqual(len(pids), 2)
+		self.assertTrue(diagnostics.want_stop)
+
+class TestDiagnostics(unittest.TestCase):
+	def test_report(self):
+		reports = []
+
+		diagnostics = ec3k.Diagnostics(interval=0.1, callback=reports.append)
+		diagnostics.start()
+		time.sleep(0.5)
+		diagnostics.stop()
+
+		self.assertTrue(reports)
+
+		report = reports[-1]
+		self.assertTrue(report['gc']['objects'] > 0)
+		self.assertTrue('decode' in report['stages'])
+
+	def test_objects(self):
+		hex_bytes = read_packets(1)[0]
+
+		diagnostics = ec3k.Diagnostics()
+
+		def count():
+			return diagnostics.report()['stages']['decode']['objects']
+
+		before = count()
+
+		states = [ ec3k.EnergyCount3KState(hex_bytes) for n in xrange(10) ]
+		self.assertEqual(count(), before + 10)
+
+		del states
+		self.assertEqual(count(), before)
+
+		states = [ ec3k.EnergyCount3KState(hex_bytes) for n in xrange(10) ]
+		self.assertTrue(diagnostics.report()['stages']['decode']['growth_objects'] > 0)
+
+	def test_update(self):
+		diagnostics = ec3k.Diagnostics()
+		diagnostics.update('capture', {'dropped': 2})
+
+		self.assertEqual(diagnostics.report()['stages']['capture'], {'dropped': 2})
+
+class TestDecodePlan(unittest.TestCase):
+	def test_extract(self):
+		plan = ec3k.DecodePlan(
+				[ ('a', [ (0, 1) ]), ('b', [ (3, 4), (1, 3) ]) ],
+				[ (4, 6) ], 6)
+
+		fields = plan.extract(0x9abc00)
+		self.assertEqual(fields['a'], 0x9)
+		self.assertEqual(fields['b'], 0xcab)
+
+		self.assertEqual(plan.padding_mask, 0xff)
+		self.assertEqual(plan.extract_padding(0x9abc12), [ 0x12 ])
+
+class TestSink(unittest.TestCase):
+	def setUp(self):
+		self.state = ec3k.EnergyCount3KState(HEX_BYTES)
+
+		self.server = socket.socket()
+		self.server.bind(('127.0.0.1', 0))
+		self.port = self.server.getsockname()[1]
+
+		self.tempdir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		self.server.close()
+		shutil.rmtree(self.tempdir)
+
+	def _readlines(self, conn, n):
+		f = conn.makefile()
+		return [ json.loads(f.readline()) for i in xrange(n) ]
+
+	def test_tcp_batch(self):
+		self.server.listen(1)
+
+		sink = ec3k.TCPSink('127.0.0.1', self.port, batch_size=2)
+		sink.put(self.state)
+		sink.put(self.state)
+
+		conn, addr = self.server.accept()
+		lines = self._readlines(conn, 2)
+		self.assertEqual(lines[0]['id'], 0xf100)
+		self.assertEqual(lines[1]['energy'], 138854)
+
+		sink.close()
+		conn.close()
+
+	def test_tcp_batch_interval(self):
+		self.server.listen(1)
+
+		sink = ec3k.TCPSink('127.0.0.1', self.port, batch_size=10, batch_interval=0.2)
+		sink.put(self.state)
+
+		# sent by the timer, without further calls to put()
+		conn, addr = self.server.accept()
+		lines = self._readlines(conn, 1)
+		self.assertEqual(lines[0]['id'], 0xf100)
+
+		sink.close()
+		conn.close()
+
+	def test_spill_error(self):
+		spill_path = os.path.join(self.tempdir, "missing", "tcp.spill")
+		sink = ec3k.TCPSink('127.0.0.1', self.port, spill_path=spill_path)
+
+		# Nothing is listening and spill directory doesn't exist
+		sink.put(self.state)
+		self.assertFalse(os.path.exists(spill_path))
+
+	def test_tcp_spill(self):
+		spill_path = os.path.join(self.tempdir, "tcp.spill")
+		sink = ec3k.TCPSink('127.0.0.1', self.port, spill_path=spill_path)
+
+		# Nothing is listening yet
+		sink.put(self.state)
+		self.assertFalse(sink.connected)
+		self.assertEqual(len(open(spill_path).readlines()), 1)
+
+		self.server.listen(1)
+		sink.retry_time = 0
+		sink.put(self.state)
+
+		conn, addr = self.server.accept()
+		lines = self._readlines(conn, 2)
+		self.assertEqual(lines[0], lines[1])
+		self.assertFalse(os.path.exists(spill_path))
+
+		sink.close()
+		conn.close()
+
+	def _recvlines(self, sock, n):
+		sock.settimeout(5.0)
+
+		datagrams = []
+		lines = []
+		while len(lines) < n:
+			datagram = sock.recv(65536)
+			datagrams.append(datagram)
+			lines += [ json.loads(line) for line in datagram.splitlines() ]
+
+		return datagrams, lines
+
+	def test_udp_max_size(self):
+		server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		server.bind(('127.0.0.1', 0))
+		port = server.getsockname()[1]
+
+		sink = ec3k.UDPSink('127.0.0.1', port, batch_size=10, max_size=600)
+		for n in xrange(10):
+			sink.put(self.state)
+
+		datagrams, lines = self._recvlines(server, 10)
+		self.assertTrue(len(datagrams) > 1)
+		for datagram in datagrams:
+			self.assertTrue(len(datagram) <= 600)
+			self.assertTrue(datagram.endswith("\n"))
+
+		# packed as tightly as possible
+		line_size = len(datagrams[0].splitlines(True)[0])
+		for datagram in datagrams[:-1]:
+			self.assertTrue(len(datagram) + line_size > 600)
+
+		self.assertEqual(len(lines), 10)
+		self.assertEqual([ line['energy'] for line in lines ], [ 138854 ] * 10)
+
+		sink.close()
+		server.close()
+
+	def test_udp_spill(self):
+		server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		server.bind(('127.0.0.1', 0))
+		port = server.getsockname()[1]
+		server.close()
+
+		spill_path = os.path.join(self.tempdir, "udp.spill")
+		sink = ec3k.UDPSink('127.0.0.1', port, spill_path=spill_path)
+
+		# Nothing is listening. The first datagram is lost, the
+		# resulting ICMP error makes the second send fail.
+		sink.put(self.state)
+		time.sleep(0.1)
+		sink.put(self.state)
+		self.assertFalse(sink.connected)
+		self.assertEqual(len(open(spill_path).readlines()), 1)
+
+		server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		server.bind(('127.0.0.1', port))
+
+		sink.retry_time = 0
+		sink.put(self.state)
+
+		datagrams, lines = self._recvlines(server, 2)
+		self.assertEqual(lines[0], lines[1])
+		self.assertFalse(os.path.exists(spill_path))
+
+		sink.close()
+		server.close()
+
+	def test_mqtt(self):
+		self.server.listen(1)
+
+		def broker(result):
+			conn, addr = self.server.accept()
+			conn.recv(1024)
+			conn.sendall("\x20\x02\x00\x00")
+			result.append(conn.recv(1024))
+			conn.close()
+
+		result = []
+		thread = threading.Thread(target=broker, args=(result,))
+		thread.start()
+
+		sink = ec3k.MQTTSink('127.0.0.1', self.port)
+		sink.put(self.state)
+		thread.join()
+		sink.close()
+
+		packet = result[0]
+		self.assertEqual(ord(packet[0]), 0x30)
+		self.assertTrue("ec3k/f100" in packet)
+		self.assertEqual(json.loads(packet[packet.index('{'):])['id'], 0xf100)